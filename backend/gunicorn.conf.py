@@ -0,0 +1,20 @@
+# Gunicorn 配置：多进程 + UvicornWorker，让 Pillow 编解码、Pydantic 校验等 CPU 开销分摊到多个核心
+# 启动方式（在 backend 目录下执行）：gunicorn -c gunicorn.conf.py main:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# 每个 worker 是独立进程，各自持有参考图缓存（main.REFERENCE_IMAGE_CACHE_BYTES，64 MiB）和上传图片解码缓存
+# （64 MiB），再加上 Gemini 客户端、线程池等，满载时单个 worker 约占 200~250 MB 内存。
+# 请求大部分时间在等待 Gemini，worker 数不需要随核数线性增长，默认最多 4 个；内存充足时可用 WEB_CONCURRENCY 调大
+MAX_DEFAULT_WORKERS = 4
+workers = int(os.getenv("WEB_CONCURRENCY", min(2 * (os.cpu_count() or 1) + 1, MAX_DEFAULT_WORKERS)))
+worker_class = "uvicorn_worker.UvicornWorker"
+keepalive = 30
+
+# 图片生成带重试时单个请求可能超过默认的 30 秒
+timeout = 120
+graceful_timeout = 30
+
+# 不使用 preload_app：每个 worker 在 fork 之后各自创建 Gemini 客户端和线程池。
+# 故事文本缓存（SQLite）在同一台机器的 worker 之间共享；参考图缓存是进程内的，各 worker 独立命中
+preload_app = False
@@ -1,21 +1,39 @@
 import os
-import json
+import orjson
 import re
 import uuid
 import asyncio
 import base64 # [新增] 用于处理 Base64 图片数据
+import hashlib
+import sys
+import sqlite3
+import threading
+from contextlib import asynccontextmanager, closing
+from concurrent.futures import ThreadPoolExecutor
+# [新增] 使用 uvloop 作为事件循环（需在导入 FastAPI 之前设置）；uvloop 不支持 Windows，此时保留默认事件循环
+if sys.platform != "win32":
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, model_validator
-from typing import List, Optional, Union # [修改] Union 用于更灵活的类型提示
+from fastapi.responses import FileResponse, ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict, model_validator
+from typing import Callable, List, Optional, Tuple, Union # [修改] Union 用于更灵活的类型提示
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import time
+import aiofiles
+import aiofiles.os
+import httpx
 from google import genai
 from google.genai import types
 
 from PIL import Image
 from io import BytesIO
+from urllib.parse import urlparse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+from cachetools import LRUCache
 
 load_dotenv()
 os.makedirs("generated_images", exist_ok=True)
@@ -23,24 +41,79 @@ os.makedirs("generated_images", exist_ok=True)
 google_api_key = os.getenv("GEMINI_API_KEY")
 if not google_api_key:
     raise ValueError("GEMINI_API_KEY not found in .env file")
-gemini_client = genai.Client(api_key=google_api_key)
+# [新增] 底层 httpx 客户端开启 HTTP/2 并保持长连接，多次调用复用同一条 TLS 连接
+gemini_client = genai.Client(
+    api_key=google_api_key,
+    http_options=types.HttpOptions(client_args={
+        "http2": True,
+        "limits": httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+    }),
+)
+
+# [新增] 启动时发起一次轻量的元数据请求，提前完成 DNS/TCP/TLS 握手，首个用户请求无需再建连
+def _blocking_warm_up_gemini_client() -> None:
+    next(iter(gemini_client.models.list(config={"page_size": 1})), None)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await asyncio.to_thread(_blocking_warm_up_gemini_client)
+        print("Gemini 客户端连接预热完成。")
+    except Exception as e:
+        print(f"Gemini 客户端连接预热失败（不影响启动）: {e}")
+    yield
 
 
 # --- FastAPI 应用设置 ---
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 origins = [FRONTEND_URL]
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 BASE_URL = os.getenv("RENDER_EXTERNAL_URL", f"http://127.0.0.1:8000")
 
-app.mount("/images", StaticFiles(directory="generated_images"), name="images")
+# [新增] 生成的图片以 UUID 命名、写入后不再修改，可以让浏览器长期缓存；ETag 直接使用文件名，重复请求可立即返回 304
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+class ImmutableStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+        response.headers["Cache-Control"] = IMAGE_CACHE_CONTROL
+        response.headers["ETag"] = f'"{os.path.splitext(os.path.basename(full_path))[0]}"'
+        if self.is_not_modified(response.headers, Headers(scope=scope)):
+            return NotModifiedResponse(response.headers)
+        return response
+
+app.mount("/images", ImmutableStaticFiles(directory="generated_images"), name="images")
 
 
 
 
 IMAGE_CONSISTENCY_RULE = "you should maintain visual consistency for the main character based on the reference image provided. The character's appearance, features, clothing, and colors must be exactly the same. Now, generate the following scene:"
 
+# [修改] 系统提示词提升为模块常量，同时参与故事缓存的 key 计算
+STORY_SYSTEM_PROMPT = """
+    你是一个富有想象力的互动故事讲述者。你的任务是根据用户的【选择】或【自定义的行动】，继续编织一个引人入胜的故事。
+    如果用户提供了一张图片，请你以图片中的主要物体（比如某个人的照片、小动物、小玩具等）作为故事的主角。如果用户同时提供了主角名称，请将这个名称赋予图片中的主角。
+    你的讲述对象是4-9岁的儿童。你必须用给小朋友讲故事的语气来创作。
+    你的故事必须通俗易懂，适合小朋友阅读，不要出现复杂难懂的语言。
+    你的故事中不能出现暴力、恐怖、血腥等不适宜的内容。你的语言必须是中文。
+    你的故事最好具有教育意义。
+    你的回答必须严格遵循一个 JSON 格式。这个 JSON 对象必须包含以下【四个】键：
+    1. "text": (字符串) 故事的下一段描述，必须紧密衔接上文，并【体现用户行动的结果】。
+    2. "image_prompt": (字符串) 一句英文的、详细描述性的、儿童插画风格的提示词(kids story book illustration style)，概括 "text" 中的场景，确保主角特征明确，并与图片中的主角保持一致。
+    3. "choices": (数组) 一个包含两个故事选项的数组。每个选项都是一个对象，包含 "id" (A 或 B) 和 "text" (选项的描述文本)。
+    4. "main_quest": (字符串) 必须是一个明确的、可执行的、贯穿整个故事的核心任务。例如：“帮助小松鼠奇奇找到回家的三颗魔法橡果”或“收集五种颜色的花瓣来治愈生病的精灵女王”。它必须是一个清晰的目标，而不是一个模糊的主题。
+    不要在你的回答中包含任何解释或除了这个JSON对象之外的任何其他文本。
+    """
+
+# [修改] 生成配置在模块加载时构建一次，不再每次调用都重新创建（SDK 只读取该对象，不会修改）
+STORY_GENERATION_CONFIG = types.GenerateContentConfig(
+    system_instruction=STORY_SYSTEM_PROMPT,
+    response_mime_type="application/json",
+    thinking_config=types.ThinkingConfig(thinking_budget=0)
+)
+
 
 # --- 数据模型定义 ---
 class StoryStartRequest(BaseModel):
@@ -64,6 +137,8 @@ class StoryStartRequest(BaseModel):
         return data
 
 class StoryChoice(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: str
     text: str
 
@@ -73,19 +148,36 @@ class ImageGenerationRequest(BaseModel):
     initial_image_data_url: Optional[str] = None # 用于故事开始的第一张图
 
 class StoryResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     text: str
     choices: List[StoryChoice]
     main_quest: str
     image_prompt: str # [修改]
     image_url: Optional[str] = None
+    # [新增] 下一幕可用的前情梗概：覆盖本次请求历史中除最后一幕以外的前 story_summary_acts 幕，客户端下一次调用 next_step 时带回
+    story_summary: Optional[str] = None
+    story_summary_acts: Optional[int] = None
+
+# [新增] 历史记录只读取 text / choices / main_quest，其余字段（image_prompt、image_url 等）直接忽略，不再逐个校验
+class StoryHistoryItem(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
+    text: str
+    choices: List[StoryChoice]
+    main_quest: str
 
 class NextStepRequest(BaseModel):
     choice_id: Optional[str] = None
     user_action: Optional[str] = None
-    story_history: List[StoryResponse]
+    story_history: List[StoryHistoryItem]
     previous_image_url: Optional[str] = None
     current_step: int
     total_steps: int
+    # [新增] 可选：上一幕响应中返回的梗概及其覆盖的幕数，原样带回即可。
+    # 只有当 story_summary_acts 恰好等于 len(story_history) - 2（即覆盖除最后两幕以外的所有幕次）时才会被使用
+    story_summary: Optional[str] = None
+    story_summary_acts: Optional[int] = None
 
     @model_validator(mode='before')
     @classmethod
@@ -98,61 +190,205 @@ class NextStepRequest(BaseModel):
             raise ValueError('必须提供 choice_id 或 user_action 中的一个')
         return data
 
+# --- 缓存 ---
+# [新增] 故事文本缓存：以 SQLite 持久化，多个 worker 进程可以共享命中
+# 生成结果并不确定（默认 temperature），条目在 ttl 秒后过期，避免同一个 prompt 永远得到同一个故事；过期条目在写入时顺带清理
+class LLMCache:
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_created_at ON llm_cache (created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    def _get(self, key: str) -> Optional[dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def _set(self, key: str, value: dict) -> None:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, orjson.dumps(value), now)
+            )
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+
+    async def get(self, key: str) -> Optional[dict]:
+        try:
+            return await asyncio.to_thread(self._get, key)
+        except sqlite3.Error as e:
+            print(f"读取故事缓存失败: {e}")
+            return None
+
+    async def set(self, key: str, value: dict) -> None:
+        try:
+            await asyncio.to_thread(self._set, key, value)
+        except sqlite3.Error as e:
+            print(f"写入故事缓存失败: {e}")
+
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", 3600))
+llm_cache = LLMCache(os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3"), ttl=LLM_CACHE_TTL_SECONDS)
+
+# key = sha256(系统提示词 + prompt + 上传图片 Base64 内容的摘要)；next_step 的 prompt 已包含历史剧情，因此上下文不同不会误命中
+# 摘要直接复用 decode_base64_payload 算出的值，不再对解码后的像素做哈希
+def _story_cache_key(prompt: str, image_digest: str = "") -> str:
+    payload = {"system_prompt": STORY_SYSTEM_PROMPT, "prompt": prompt, "image": image_digest}
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
 # --- 工具函数 ---
-# [新增] 将 Base64 字符串解码为 PIL Image 对象
-def decode_base64_to_image(base64_string: str) -> Image.Image:
+# [新增] 已解码的上传图片缓存：按 Base64 内容的哈希索引，缓存解码后的字节（Image 对象可变，不直接缓存），总容量按字节计
+_decoded_image_cache: LRUCache = LRUCache(maxsize=64 * 1024 * 1024, getsizeof=len)
+_decoded_image_cache_lock = threading.Lock()
+
+# [新增] 解码 Base64 图片数据，返回 (内容摘要, 原始文件字节)
+def decode_base64_payload(base64_string: str) -> Tuple[str, bytes]:
     # 移除 "data:image/png;base64," 或 "data:image/jpeg;base64," 等前缀
-    if "," in base64_string:
-        header, base64_data = base64_string.split(",", 1)
-    else:
-        base64_data = base64_string
+    # [修改] 逗号只会出现在开头的前缀里，只在前 64 个字符内查找，避免对 MB 级的字符串做整串扫描
+    comma = base64_string.find(",", 0, 64)
+    base64_data = base64_string[comma + 1:] if comma != -1 else base64_string
     
-    img_bytes = base64.b64decode(base64_data)
-    return Image.open(BytesIO(img_bytes))
+    cache_key = hashlib.blake2b(base64_data.encode("ascii"), digest_size=16).digest()
+    with _decoded_image_cache_lock:
+        img_bytes = _decoded_image_cache.get(cache_key)
+    if img_bytes is None:
+        img_bytes = base64.b64decode(base64_data, validate=False)
+        if len(img_bytes) <= _decoded_image_cache.maxsize:
+            with _decoded_image_cache_lock:
+                _decoded_image_cache[cache_key] = img_bytes
+    return cache_key.hex(), img_bytes
+
+# [新增] Gemini 可以直接接收的图片格式；其他格式（GIF、BMP 等）先转成 PNG
+GEMINI_IMAGE_MIME_TYPES = frozenset({"image/png", "image/jpeg", "image/webp", "image/heic", "image/heif"})
+
+# [新增] 把图片文件字节包装成 Gemini 的 Part：只解析文件头识别格式，原始字节原样发送。
+# 不把 PIL Image 交给 SDK——SDK 会把非 PngImageFile 的图一律重新编码成 JPEG（调色板/LA 模式直接报错，PNG 变成有损）
+def image_part_from_bytes(img_bytes: bytes) -> types.Part:
+    image = Image.open(BytesIO(img_bytes))
+    mime_type = image.get_format_mimetype()
+    if mime_type not in GEMINI_IMAGE_MIME_TYPES:
+        buffer = BytesIO()
+        image.convert("RGBA").save(buffer, format="PNG", compress_level=1)
+        img_bytes, mime_type = buffer.getvalue(), "image/png"
+    return types.Part.from_bytes(data=img_bytes, mime_type=mime_type)
+
+# [修改] 进程内唯一的参考图缓存（LRU）：内存中生成/上传的图按 image_url 索引，从磁盘读入的图按 "路径:mtime" 索引，
+# 缓存的是编码后的图片字节（types.Part），后续幕次直接发送，不需要解码或重新编码。只在事件循环线程中读写；
+# Part 在发送时只会被序列化、不会被修改，多个请求可以共用同一个对象。容量按编码后的字节数计算，而不是按条目数
+REFERENCE_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+_reference_images: LRUCache = LRUCache(
+    maxsize=REFERENCE_IMAGE_CACHE_BYTES,
+    getsizeof=lambda part: len(part.inline_data.data)
+)
+
+def _cache_reference_image(cache_key: str, image_part: types.Part) -> None:
+    if _reference_images.getsizeof(image_part) <= _reference_images.maxsize:
+        _reference_images[cache_key] = image_part
+
+def remember_reference_image(image_url: str, image_part: types.Part) -> None:
+    _cache_reference_image(image_url, image_part)
+
+def lookup_reference_image(image_url: str) -> Optional[types.Part]:
+    return _reference_images.get(image_url)
+
+def _read_image_file(path: str) -> types.Part:
+    with open(path, "rb") as f:
+        return image_part_from_bytes(f.read())
+
+# [新增] 把图片 URL 映射到 generated_images 下的本地路径；只取 URL path 的文件名部分，拒绝 "."、".." 防止路径穿越
+def local_image_path_from_url(image_url: str) -> Optional[str]:
+    name = os.path.basename(urlparse(image_url).path)
+    if not name or name in (".", ".."):
+        return None
+    return os.path.join("generated_images", name)
+
+# stat_result 由调用方的 os.stat 提供，存在性检查和 mtime 只需一次系统调用
+async def load_image_file(path: str, stat_result: os.stat_result) -> types.Part:
+    cache_key = f"{path}:{stat_result.st_mtime_ns}"
+    image_part = _reference_images.get(cache_key)
+    if image_part is None:
+        image_part = await asyncio.to_thread(_read_image_file, path)
+        _cache_reference_image(cache_key, image_part)
+    return image_part
+
+# [新增] 解码用户上传的参考图，返回 (图片 Part, 内容摘要)：摘要用于故事缓存的 key，Part 中的字节可直接落盘
+def _decode_reference_image(base64_string: str) -> Tuple[types.Part, str]:
+    image_digest, img_bytes = decode_base64_payload(base64_string)
+    return image_part_from_bytes(img_bytes), image_digest
 
 # --- 核心AI函数 ---
 # [修改] 增加可选的 image_input 参数
-def _blocking_generate_story_part(prompt: str, image_input: Optional[Image.Image] = None) -> str:
-    system_prompt = """
-    你是一个富有想象力的互动故事讲述者。你的任务是根据用户的【选择】或【自定义的行动】，继续编织一个引人入胜的故事。
-    如果用户提供了一张图片，请你以图片中的主要物体（比如某个人的照片、小动物、小玩具等）作为故事的主角。如果用户同时提供了主角名称，请将这个名称赋予图片中的主角。
-    你的讲述对象是4-9岁的儿童。你必须用给小朋友讲故事的语气来创作。
-    你的故事必须通俗易懂，适合小朋友阅读，不要出现复杂难懂的语言。
-    你的故事中不能出现暴力、恐怖、血腥等不适宜的内容。你的语言必须是中文。
-    你的故事最好具有教育意义。
-    你的回答必须严格遵循一个 JSON 格式。这个 JSON 对象必须包含以下【四个】键：
-    1. "text": (字符串) 故事的下一段描述，必须紧密衔接上文，并【体现用户行动的结果】。
-    2. "image_prompt": (字符串) 一句英文的、详细描述性的、儿童插画风格的提示词(kids story book illustration style)，概括 "text" 中的场景，确保主角特征明确，并与图片中的主角保持一致。
-    3. "choices": (数组) 一个包含两个故事选项的数组。每个选项都是一个对象，包含 "id" (A 或 B) 和 "text" (选项的描述文本)。
-    4. "main_quest": (字符串) 必须是一个明确的、可执行的、贯穿整个故事的核心任务。例如：“帮助小松鼠奇奇找到回家的三颗魔法橡果”或“收集五种颜色的花瓣来治愈生病的精灵女王”。它必须是一个清晰的目标，而不是一个模糊的主题。
-    不要在你的回答中包含任何解释或除了这个JSON对象之外的任何其他文本。
-    """
-
-    generation_config = types.GenerateContentConfig(
-        system_instruction=system_prompt,
-        response_mime_type="application/json",
-        thinking_config=types.ThinkingConfig(thinking_budget=0)
-    )
-
+# [新增] 流式生成：每收到一段文本就通过 call_soon_threadsafe 投递到事件循环的队列中，结束时投递 None
+def _blocking_generate_story_part(prompt: str, image_input: Optional[types.Part], loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> None:
     # [修改] 根据是否有图片输入构建 contents
-    contents: List[Union[str, Image.Image]] = []
+    contents: List[Union[str, types.Part]] = []
     if image_input:
         contents.append(image_input)
     contents.append(prompt) # 用户prompt总是最后一个
 
-    response = gemini_client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=contents,
-        config=generation_config
+    try:
+        for chunk in gemini_client.models.generate_content_stream(
+            model="gemini-2.5-flash",
+            contents=contents,
+            config=STORY_GENERATION_CONFIG
+        ):
+            if chunk.text:
+                loop.call_soon_threadsafe(queue.put_nowait, chunk.text)
+    finally:
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+
+# [新增] 在尚未完整的 JSON 文本中匹配已经闭合的 "image_prompt" 字符串
+IMAGE_PROMPT_PATTERN = re.compile(r'"image_prompt"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+# [新增] 检查模型返回的 JSON 是否具备各接口要用到的字段；形状不对的响应不能写入缓存，否则同一请求会一直命中坏数据
+def _is_valid_story_data(ai_data) -> bool:
+    if not isinstance(ai_data, dict):
+        return False
+    if not all(isinstance(ai_data.get(field), str) for field in ("text", "image_prompt", "main_quest")):
+        return False
+    choices = ai_data.get("choices")
+    return isinstance(choices, list) and all(
+        isinstance(choice, dict) and "id" in choice and "text" in choice for choice in choices
     )
-    return response.text
 
-# [修改] 增加可选的 image_input 参数
-async def generate_story_part(prompt: str, image_input: Optional[Image.Image] = None) -> dict:
+# [修改] 增加可选的 image_input 参数；[新增] on_image_prompt 回调，image_prompt 一解析出来就立即触发
+# image_digest：image_input 对应上传内容的摘要；带图但没有摘要时不走缓存
+async def generate_story_part(prompt: str, image_input: Optional[types.Part] = None, on_image_prompt: Optional[Callable[[str], None]] = None, image_digest: Optional[str] = None) -> dict:
+    response_text = ""
     try:
-        response_text = await asyncio.to_thread(_blocking_generate_story_part, prompt, image_input)
-        return json.loads(response_text)
-    except json.JSONDecodeError as e:
+        cache_key = _story_cache_key(prompt, image_digest or "") if image_input is None or image_digest else None
+        cached = await llm_cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            print("故事缓存命中，跳过 Gemini 调用。")
+            return cached
+
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        producer = asyncio.create_task(asyncio.to_thread(_blocking_generate_story_part, prompt, image_input, loop, queue))
+        while (chunk := await queue.get()) is not None:
+            response_text += chunk
+            if on_image_prompt:
+                match = IMAGE_PROMPT_PATTERN.search(response_text)
+                if match:
+                    on_image_prompt(orjson.loads(match.group(1)))
+                    on_image_prompt = None
+        await producer
+        ai_data = orjson.loads(response_text)
+        if not _is_valid_story_data(ai_data):
+            print(f"Gemini response JSON has an unexpected shape: {response_text}")
+            raise HTTPException(status_code=500, detail="AI response was not valid JSON.")
+        if cache_key:
+            await llm_cache.set(cache_key, ai_data)
+        return ai_data
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON from Gemini response: {e}")
         print(f"Raw Gemini response: {response_text}")
         raise HTTPException(status_code=500, detail="AI response was not valid JSON.")
@@ -161,59 +397,117 @@ async def generate_story_part(prompt: str, image_input: Optional[Image.Image] =
         if isinstance(e, HTTPException): raise e
         raise HTTPException(status_code=500, detail="An unexpected error occurred with the Gemini service.")
 
-# 图片生成函数（无变化，完全保留您的版本）
-def _blocking_image_generation(prompt: str, previous_image: Optional[Image.Image] = None) -> bytes:
-    contents = [prompt]
+# [修改] 图片生成函数：只做单次尝试，失败直接抛出；重试与退避移到异步包装器中，避免 sleep 占用工作线程
+def _blocking_image_generation(prompt: str, previous_image: Optional[types.Part] = None) -> bytes:
+    contents: List[Union[str, types.Part]] = [prompt]
     if previous_image:
         contents.append(previous_image)
     
-    max_retries = 3
-    initial_delay = 2  # 初始延遲2秒
-
-    for attempt in range(max_retries):
+    response = gemini_client.models.generate_content(model="gemini-2.5-flash-image-preview", contents=contents)
+    for part in response.candidates[0].content.parts:
+        if part.inline_data is not None:
+            return part.inline_data.data
+    raise ValueError("API虽成功但未返回图片数据")
+
+# [新增] 图片生成使用独立的有界线程池，突发流量下不会挤占 FastAPI 默认线程池；信号量让排队的请求在事件循环中等待
+IMAGE_GENERATION_CONCURRENCY = 8
+_image_pool = ThreadPoolExecutor(max_workers=IMAGE_GENERATION_CONCURRENCY, thread_name_prefix="gemini-img")
+_image_semaphore = asyncio.Semaphore(IMAGE_GENERATION_CONCURRENCY)
+
+IMAGE_GENERATION_MAX_RETRIES = 3
+IMAGE_GENERATION_INITIAL_DELAY = 2  # 初始延遲2秒
+
+# [新增] 带指数退避的异步重试：等待期间用 asyncio.sleep，不阻塞线程池
+async def _generate_image_with_retry(prompt: str, previous_image: Optional[types.Part] = None) -> bytes:
+    for attempt in range(IMAGE_GENERATION_MAX_RETRIES):
         try:
-            # 嘗試呼叫 API
-            response = gemini_client.models.generate_content(model="gemini-2.5-flash-image-preview", contents=contents)
-            for part in response.candidates[0].content.parts:
-                if part.inline_data is not None:
-                    print(f"图片生成成功 (尝试第 {attempt + 1} 次)")
-                    return part.inline_data.data
-            raise ValueError("API虽成功但未返回图片数据")
-        
+            async with _image_semaphore:
+                loop = asyncio.get_running_loop()
+                image_data = await loop.run_in_executor(_image_pool, _blocking_image_generation, prompt, previous_image)
+            print(f"图片生成成功 (尝试第 {attempt + 1} 次)")
+            return image_data
         except Exception as e:
-            print(f"图片生成失敗 (尝试第 {attempt + 1}/{max_retries} 次): {e}")
-            if attempt < max_retries - 1:
+            print(f"图片生成失敗 (尝试第 {attempt + 1}/{IMAGE_GENERATION_MAX_RETRIES} 次): {e}")
+            if attempt < IMAGE_GENERATION_MAX_RETRIES - 1:
                 # 如果不是最後一次嘗試，則等待一段時間後重試
-                delay = initial_delay * (2 ** attempt) # 指數退避：2s, 4s, 8s
+                delay = IMAGE_GENERATION_INITIAL_DELAY * (2 ** attempt) # 指數退避：2s, 4s
                 print(f"將在 {delay} 秒后重试...")
-                time.sleep(delay)
+                await asyncio.sleep(delay)
             else:
                 # 如果所有嘗試都失敗了，則將錯誤向上拋出
                 print("所有重试均失敗，放弃生成图片。")
-                raise e # 重新引發最後一次的異常
+                raise
 
     raise ValueError("未能从API相应中获取图片数据，且重试机制异常结束")
 
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# [新增] 图片落盘：2 MiB 大缓冲减少系统调用（网络文件系统上尤其明显）；先写临时文件再 os.replace，
+# 保证 /images 永远不会读到写了一半的文件
+IMAGE_WRITE_BUFFER_SIZE = 2 * 1024 * 1024
+
+# [修改] 模型返回的 PNG 原始字节用 aiofiles 直接写盘，全程不经过 Pillow
+# 写入或编码失败（包括任务被取消）时删除临时文件，避免残留文件被 /images 以长期缓存头对外提供
+async def write_image_bytes(save_path: str, image_data: bytes) -> None:
+    tmp_path = f"{save_path}.tmp"
+    try:
+        async with aiofiles.open(tmp_path, "wb", buffering=IMAGE_WRITE_BUFFER_SIZE) as f:
+            await f.write(image_data)
+        await aiofiles.os.replace(tmp_path, save_path)
+    except BaseException:
+        _remove_tmp_file(tmp_path)
+        raise
+
+def _encode_png(image_data: bytes) -> bytes:
+    buffer = BytesIO()
+    Image.open(BytesIO(image_data)).save(buffer, format="PNG", compress_level=1, optimize=False) # [修改] 低压缩级别，显著降低 PNG 编码的 CPU 开销
+    return buffer.getvalue()
+
+def _remove_tmp_file(tmp_path: str) -> None:
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+# [新增] 按 URL 取得上一张图：先查内存缓存，再从 generated_images 读盘（读取在线程中完成）；找不到时返回 None
+async def load_previous_image(previous_image_url: str) -> Optional[types.Part]:
+    previous_image_object = lookup_reference_image(previous_image_url)
+    if previous_image_object:
+        print(f"内存中找到上一张图片: {previous_image_url}，用于保持角色一致性。")
+        return previous_image_object
+    local_image_path = local_image_path_from_url(previous_image_url)
+    if not local_image_path:
+        return None
+    try:
+        stat_result = os.stat(local_image_path)
+    except FileNotFoundError:
+        return None
+    print(f"找到上一张图片: {local_image_path}，用于保持角色一致性。")
+    return await load_image_file(local_image_path, stat_result)
+
+
 # 图片生成异步包装器
-async def generate_consistent_image(prompt: str, previous_image_url: Optional[str] = None, initial_image: Optional[Image.Image] = None) -> str:
+# previous_image_loaded：调用方已经尝试加载过 previous_image_url（结果即 initial_image，可能为 None），不再重复查找
+async def generate_consistent_image(prompt: str, previous_image_url: Optional[str] = None, initial_image: Optional[types.Part] = None, previous_image_loaded: bool = False) -> str:
     try:
         previous_image_object = initial_image
-        if not previous_image_object and previous_image_url:
-            local_image_path = os.path.join("generated_images", os.path.basename(previous_image_url))
-            if os.path.exists(local_image_path):
-                print(f"找到上一张图片: {local_image_path}，用于保持角色一致性。")
-                previous_image_object = Image.open(local_image_path)
+        if not previous_image_object and previous_image_url and not previous_image_loaded:
+            previous_image_object = await load_previous_image(previous_image_url)
         
-        image_data = await asyncio.to_thread(_blocking_image_generation, prompt, previous_image_object)
+        image_data = await _generate_image_with_retry(prompt, previous_image_object)
         
-        image = Image.open(BytesIO(image_data))
-        os.makedirs("generated_images", exist_ok=True)
         filename = f"{uuid.uuid4()}.png"
         save_path = os.path.join("generated_images", filename)
-        image.save(save_path)
-        
         image_url = f"{BASE_URL}/images/{filename}"
+        # [新增] 模型返回的已经是 PNG 时直接写入原始字节，省去一次完整的解码 + 重新编码；
+        # 其他格式（如 JPEG）才交给 Pillow 转成 PNG，无法识别的数据会在这里抛出异常
+        if not image_data.startswith(PNG_SIGNATURE):
+            image_data = await asyncio.to_thread(_encode_png, image_data)
+        await write_image_bytes(save_path, image_data)
+        remember_reference_image(image_url, types.Part.from_bytes(data=image_data, mime_type="image/png"))
+        
         print(f"新图片已生成并保存: {image_url}")
         return image_url
         
@@ -229,16 +523,122 @@ async def generate_consistent_image(prompt: str, previous_image_url: Optional[st
             return f"https://via.placeholder.com/512x512.png?text=Image+Generation+Failed"
 
 
+# [新增] 长故事的梗概压缩：超过 STORY_SUMMARY_THRESHOLD 幕时，较早的幕次用一段梗概代替，只有最近两幕原文发送，
+# 每一幕的 prompt 长度不再随故事线性增长。梗概存放在共享的 SQLite 缓存中（key 为所概括幕次文本的 sha256），
+# 多个 worker 之间都能命中；同时随响应返回给客户端，客户端下一幕可以原样带回
+STORY_SUMMARY_THRESHOLD = 3
+RECENT_ACTS_VERBATIM = 2
+_background_tasks: set = set()
+
+STORY_SUMMARY_CONFIG = types.GenerateContentConfig(
+    system_instruction="你负责为儿童互动故事撰写梗概。请用不超过200字的中文概括给出的情节，保留主角、主线任务、关键线索和已经取得的进展。只输出梗概本身。",
+    thinking_config=types.ThinkingConfig(thinking_budget=0)
+)
+
+def _story_summary_key(act_texts: Tuple[str, ...]) -> str:
+    return hashlib.sha256(orjson.dumps({"story_summary": act_texts})).hexdigest()
+
+async def get_story_summary(act_texts: Tuple[str, ...]) -> Optional[str]:
+    cached = await llm_cache.get(_story_summary_key(act_texts))
+    return cached["summary"] if cached else None
+
+def _blocking_summarize_story(previous_summary: Optional[str], new_acts: List[str]) -> str:
+    lines = [f"此前的故事梗概：{previous_summary}"] if previous_summary else []
+    lines.extend(f"新发生的情节：{act}" for act in new_acts)
+    response = gemini_client.models.generate_content(
+        model="gemini-2.5-flash",
+        contents="\n".join(lines),
+        config=STORY_SUMMARY_CONFIG
+    )
+    return response.text.strip()
+
+# 增量更新：已有前 N-1 幕的梗概时，只需把第 N 幕合并进去；previous_summary 为调用方已知的前 N-1 幕梗概
+async def summarize_story_acts(act_texts: Tuple[str, ...], previous_summary: Optional[str] = None) -> Optional[str]:
+    summary = await get_story_summary(act_texts)
+    if summary:
+        return summary
+    if not previous_summary:
+        previous_summary = await get_story_summary(act_texts[:-1])
+    new_acts = list(act_texts[-1:]) if previous_summary else list(act_texts)
+    try:
+        summary = await asyncio.to_thread(_blocking_summarize_story, previous_summary, new_acts)
+    except Exception as e:
+        print(f"生成故事梗概失败: {e}")
+        return None
+    await llm_cache.set(_story_summary_key(act_texts), {"summary": summary})
+    return summary
+
+def schedule_story_summary(act_texts: Tuple[str, ...], previous_summary: Optional[str] = None) -> asyncio.Task:
+    task = asyncio.create_task(summarize_story_acts(act_texts, previous_summary))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# [新增] 文本与图片并行：流式解析出 image_prompt 后立即开始生成图片，同时继续接收故事文本
+# [新增] previous_image_task：调用方提前开始加载的上一张图，图片生成时直接复用，不再重新读盘
+async def generate_story_and_image(prompt: str, image_input: Optional[types.Part] = None, previous_image_url: Optional[str] = None, previous_image_task: Optional[asyncio.Task] = None, image_digest: Optional[str] = None) -> Tuple[dict, str]:
+    image_tasks: List[asyncio.Task] = []
+
+    async def generate_scene_image(final_image_prompt: str) -> str:
+        reference_image = image_input
+        previous_image_loaded = False
+        if reference_image is None and previous_image_task is not None:
+            try:
+                reference_image = await previous_image_task
+                previous_image_loaded = True
+            except Exception as e:
+                print(f"预加载上一张图片失败: {e}")
+        return await generate_consistent_image(
+            prompt=final_image_prompt, # 使用我们合成的、带规则的 prompt
+            previous_image_url=previous_image_url,
+            initial_image=reference_image,
+            previous_image_loaded=previous_image_loaded
+        )
+
+    def start_image_generation(scene_prompt: str) -> None:
+        final_image_prompt = f"{IMAGE_CONSISTENCY_RULE} {scene_prompt}"
+        print(f"\n[AI 场景 Prompt]: {scene_prompt}")
+        print(f"[最终合成 Prompt]: {final_image_prompt}\n")
+        image_tasks.append(asyncio.create_task(generate_scene_image(final_image_prompt)))
+
+    try:
+        ai_data = await generate_story_part(prompt, image_input, on_image_prompt=start_image_generation, image_digest=image_digest)
+    except Exception:
+        for task in image_tasks:
+            task.cancel()
+        if previous_image_task is not None:
+            previous_image_task.cancel()
+        raise
+
+    if not image_tasks:
+        start_image_generation(ai_data["image_prompt"])
+    generated_image_url = await image_tasks[0]
+    return ai_data, generated_image_url
+
+
 # --- API 接口 ---
 @app.post("/start_story", response_model=StoryResponse)
 async def start_story(request: StoryStartRequest):
     print(f"收到新故事请求: 主角 {request.character if request.character else '[图片上传]'}, 场景 {request.setting}, 预计长度 {request.total_steps} 幕")
     
-    image_input_for_gemini: Optional[Image.Image] = None
+    image_input_for_gemini: Optional[types.Part] = None
+    image_digest: Optional[str] = None
+    reference_image_url: Optional[str] = None
+    save_reference_task: Optional[asyncio.Task] = None
     initial_prompt_text: str
     
     if request.image_data_url:
-        image_input_for_gemini = decode_base64_to_image(request.image_data_url)
+        image_input_for_gemini, image_digest = await asyncio.to_thread(_decode_reference_image, request.image_data_url)
+        # [新增] 参考图只落盘一次并放入内存缓存；落盘与故事生成并行进行。
+        # 直接写入发送给 Gemini 的同一份字节（扩展名取自 mime 类型），不需要重新编码
+        reference_data = image_input_for_gemini.inline_data
+        reference_filename = f"ref_{uuid.uuid4()}.{reference_data.mime_type.split('/')[1]}"
+        reference_image_url = f"{BASE_URL}/images/{reference_filename}"
+        remember_reference_image(reference_image_url, image_input_for_gemini)
+        save_reference_task = asyncio.create_task(
+            write_image_bytes(os.path.join("generated_images", reference_filename), reference_data.data)
+        )
         # [修改] 如果有图片，prompt 需要引导AI识别主角
         if request.character:
             initial_prompt_text = (
@@ -262,26 +662,29 @@ async def start_story(request: StoryStartRequest):
             f"请确保开篇能够建立一个清晰的主线任务，并为后续发展留下悬念。"
         )
     
-    ai_data = await generate_story_part(initial_prompt_text, image_input_for_gemini)
-    final_image_prompt = f"{IMAGE_CONSISTENCY_RULE} {ai_data['image_prompt']}"
-    print(f"\n[AI 场景 Prompt]: {ai_data['image_prompt']}")
-    print(f"[最终合成 Prompt]: {final_image_prompt}\n")
-    
-    generated_image_url = await generate_consistent_image(
-        prompt=final_image_prompt, # 使用我们合成的、带规则的 prompt
-        initial_image=image_input_for_gemini
-    )
+    try:
+        ai_data, generated_image_url = await generate_story_and_image(initial_prompt_text, image_input_for_gemini, previous_image_url=reference_image_url, image_digest=image_digest)
+    finally:
+        # 无论故事生成成功与否都等待落盘结束，不留下无人等待的任务
+        if save_reference_task:
+            try:
+                await save_reference_task
+            except Exception as e:
+                print(f"参考图保存失败: {e}")
     
     return StoryResponse(
         text=ai_data["text"],
         choices=[StoryChoice(**choice) for choice in ai_data["choices"]],
         main_quest=ai_data["main_quest"],
-        image_prompt=ai_data["image_prompt"]
+        image_prompt=ai_data["image_prompt"],
+        image_url=generated_image_url
     )
 
 @app.post("/next_step", response_model=StoryResponse)
 async def next_step(request: NextStepRequest):
     print(f"收到下一步请求... 当前进度: {request.current_step}/{request.total_steps}")
+    # [新增] 上一张图与本幕的故事文本无关，在调用文本模型之前就开始加载，与文本生成并行
+    previous_image_task = asyncio.create_task(load_previous_image(request.previous_image_url)) if request.previous_image_url else None
     main_quest_line = request.story_history[0].main_quest if request.story_history else "继续探索"
     action_description_line = ""
     if request.user_action:
@@ -291,11 +694,8 @@ async def next_step(request: NextStepRequest):
         print(f"用户选择选项: {request.choice_id}")
         user_choice_text = "继续"
         if request.story_history:
-            last_part = request.story_history[-1]
-            for choice in last_part.choices:
-                if choice.id == request.choice_id:
-                    user_choice_text = choice.text
-                    break
+            choice_texts = {choice.id: choice.text for choice in request.story_history[-1].choices}
+            user_choice_text = choice_texts.get(request.choice_id, user_choice_text)
         action_description_line = f"在故事的最新发展中，主角选择了选项：'{user_choice_text}'。"
     narrative_guidance = ""
     is_final_step = request.current_step == request.total_steps
@@ -316,9 +716,27 @@ async def next_step(request: NextStepRequest):
             f"请创作一段承上启下的情节。最重要的是，这一步必须让主角在完成主线任务：“{main_quest_line}” 的道路上【取得明确的进展】。\n"
             "可以引入一个帮助解决主线的线索，或者克服一个通往主线的小障碍。"
         )
-    story_context = "这是已经发生的故事梗概，请你续写：\n\n"
-    for i, part in enumerate(request.story_history):
-        story_context += f"第 {i+1} 幕: {part.text}\n"
+    act_texts = tuple(part.text for part in request.story_history)
+    summarized_acts = act_texts[:-RECENT_ACTS_VERBATIM]
+    story_summary = None
+    if len(act_texts) > STORY_SUMMARY_THRESHOLD:
+        if request.story_summary and request.story_summary_acts == len(summarized_acts):
+            story_summary = request.story_summary
+        else:
+            story_summary = await get_story_summary(summarized_acts)
+    story_context_lines = ["这是已经发生的故事梗概，请你续写：\n"]
+    if story_summary:
+        story_context_lines.append(f"第 1-{len(summarized_acts)} 幕梗概: {story_summary}")
+        first_verbatim_act = len(summarized_acts)
+    else:
+        first_verbatim_act = 0
+    for i in range(first_verbatim_act, len(act_texts)):
+        story_context_lines.append(f"第 {i+1} 幕: {act_texts[i]}")
+    story_context = "\n".join(story_context_lines) + "\n"
+    # 下一幕需要概括的正好是当前历史去掉最后一幕，趁本幕生成时在后台提前准备好
+    summary_task = None
+    if len(act_texts) + 1 > STORY_SUMMARY_THRESHOLD and not is_final_step:
+        summary_task = schedule_story_summary(act_texts[:-1], previous_summary=story_summary)
     continuation_prompt = (
         f"{story_context}\n"
         f"{action_description_line}\n\n"
@@ -328,32 +746,31 @@ async def next_step(request: NextStepRequest):
         f"{narrative_guidance}"
     )
     print(f"--- 发送给AI的最终Prompt ---\n{continuation_prompt}\n--------------------------")
-    ai_data = await generate_story_part(continuation_prompt)
+    ai_data, generated_image_url = await generate_story_and_image(
+        continuation_prompt,
+        previous_image_url=request.previous_image_url,
+        previous_image_task=previous_image_task
+    )
     if is_final_step:
         ai_data["choices"] = []
-    final_image_prompt = f"{IMAGE_CONSISTENCY_RULE} {ai_data['image_prompt']}"
-    print(f"\n[AI 场景 Prompt]: {ai_data['image_prompt']}")
-    print(f"[最终合成 Prompt]: {final_image_prompt}\n")
-    
-    generated_image_url = await generate_consistent_image(
-        prompt=final_image_prompt, # 使用我们合成的、带规则的 prompt
-        previous_image_url=request.previous_image_url
-    )
-    
-    main_quest_line = request.story_history[0].main_quest if request.story_history else "继续探索"
+    # 梗概与故事、图片并行生成，通常此时已经完成；未完成则不等待，它仍会写入共享缓存供下一幕使用
+    next_story_summary = summary_task.result() if summary_task and summary_task.done() else None
 
     return StoryResponse(
         text=ai_data["text"],
         choices=[StoryChoice(**choice) for choice in ai_data["choices"]],
-        main_quest=request.story_history[0].main_quest,
-        image_prompt=ai_data["image_prompt"]
+        main_quest=main_quest_line,
+        image_prompt=ai_data["image_prompt"],
+        image_url=generated_image_url,
+        story_summary=next_story_summary,
+        story_summary_acts=len(act_texts) - 1 if next_story_summary else None
     )
 
 @app.post("/generate_image")
 async def generate_image_endpoint(request: ImageGenerationRequest):
     initial_image = None
     if request.initial_image_data_url:
-        initial_image = decode_base64_to_image(request.initial_image_data_url)
+        initial_image, _ = await asyncio.to_thread(_decode_reference_image, request.initial_image_data_url)
         
     final_image_prompt = f"{IMAGE_CONSISTENCY_RULE} {request.image_prompt}"
     print(f"\n[收到图片生成请求]: {final_image_prompt}\n")
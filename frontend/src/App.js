@@ -137,11 +137,13 @@ function App() {
       }
       const textData = await textResponse.json();
 
-      const newStoryPart = { ...textData, image_url: null };
+      // [修改] 后端在同一个请求里生成图片并返回 image_url；只有没拿到时才单独请求 /generate_image
+      const newStoryPart = { ...textData, image_url: textData.image_url || null };
       setStory(newStoryPart);
       setStoryHistory([newStoryPart]);
       setHasStarted(true);
       setIsLoading(false);
+      if (newStoryPart.image_url) return;
 
       const imagePayload = {
         image_prompt: textData.image_prompt,
@@ -205,7 +207,9 @@ function App() {
       ...payload,
       story_history: storyHistory,
       current_step: nextStep,
-      total_steps: totalSteps
+      total_steps: totalSteps,
+      story_summary: story?.story_summary,
+      story_summary_acts: story?.story_summary_acts
     };
 
     try {
@@ -220,13 +224,14 @@ function App() {
       }
       const textData = await textResponse.json();
 
-      const newStoryPart = { ...textData, image_url: null };
+      const newStoryPart = { ...textData, image_url: textData.image_url || null };
       setStory(newStoryPart);
       const newHistory = [...storyHistory, newStoryPart];
       setStoryHistory(newHistory);
       setCurrentStep(nextStep);
       setUserAction('');
       setIsLoading(false);
+      if (newStoryPart.image_url) return;
 
       const imagePayload = {
         image_prompt: textData.image_prompt,